@@ -1,8 +1,13 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, session
+from flask import Flask, render_template, request, redirect, url_for, flash, session, g
 import sqlite3
 import pandas as pd
 import os
+import csv
+import string
 import hashlib
+import hmac
+import queue
+import threading
 from functools import wraps
 from datetime import datetime
 # ================== Flask 设置 ==================
@@ -11,21 +16,65 @@ app.secret_key = "change-this-secret-key"  # 只设一次密钥
 
 DB_PATH = "movies_acms.db"
 MOVIES_CSV_PATH = "Movies_dataset.csv"
+REPORTS_PAGE_SIZE = 50  # 报告列表每页条数
+SQL_RESULT_MAX_ROWS = 1000  # SQL 查询页最多展示的行数
 
 
 # ================== 数据库工具 ==================
 
-def get_connection():
-    """获取 SQLite 连接，并返回 Row 风格结果，模板中可用 row['title']。"""
-    conn = sqlite3.connect(DB_PATH)
+# 连接池：连接建好后在请求之间复用（PRAGMA 只设一次，页缓存和语句缓存保持热）
+_pool = queue.SimpleQueue()
+
+
+def _open_connection():
+    """新建一个 SQLite 连接（自动提交模式），返回 Row 风格结果，模板中可用 row['title']。"""
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False, isolation_level=None)
     conn.row_factory = sqlite3.Row
+    cur = conn.cursor()
+    cur.execute("PRAGMA synchronous=NORMAL;")
+    cur.execute("PRAGMA temp_store=MEMORY;")
+    cur.execute("PRAGMA mmap_size=268435456;")
+    cur.execute("PRAGMA cache_size=-65536;")
     return conn
 
+
+def _release(conn):
+    """回滚未提交的事务后把连接放回池中。"""
+    if conn.in_transaction:
+        conn.rollback()
+    _pool.put(conn)
+
+
+def _acquire():
+    """从连接池取一个空闲连接，池里没有时新建一个。"""
+    try:
+        return _pool.get_nowait()
+    except queue.Empty:
+        return _open_connection()
+
+
+def get_connection():
+    """获取当前请求（应用上下文）借用的连接，同一请求内复用，请求结束时归还连接池。"""
+    if "db_conn" not in g:
+        g.db_conn = _acquire()
+    return g.db_conn
+
+
+@app.teardown_appcontext
+def release_connection(exc):
+    """应用上下文结束时归还连接；异常路径上未提交的事务在这里回滚。"""
+    conn = g.pop("db_conn", None)
+    if conn is not None:
+        _release(conn)
+
+
 def init_db():
     """创建基本表结构。"""
     conn = get_connection()
     cur = conn.cursor()
     cur.execute("PRAGMA foreign_keys = ON;")
+    # WAL 模式写入库文件后持久生效：读写互不阻塞，提交也不必每次同步主库文件
+    cur.execute("PRAGMA journal_mode=WAL;")
 
     # 添加 users 表（用于用户信息）
     cur.execute("""
@@ -40,19 +89,41 @@ def init_db():
     """)
 
     # 已有的其他表（movies、templates 等）
-    cur.execute("""
+    # release_year 由 SQLite 从 release_date 前 4 位算出（虚拟生成列，不占存储，写入时也不用传）
+    movies_ddl = """
         CREATE TABLE IF NOT EXISTS movies (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             title TEXT NOT NULL,
             original_language TEXT,
             release_date TEXT,
-            release_year INTEGER,
+            release_year INTEGER GENERATED ALWAYS AS (
+                CASE WHEN release_date GLOB '[0-9][0-9][0-9][0-9]*'
+                     THEN CAST(substr(release_date, 1, 4) AS INTEGER) END
+            ) VIRTUAL,
             popularity REAL,
             vote_average REAL,
             vote_count INTEGER,
             overview TEXT
         );
-    """)
+    """
+    cur.execute(movies_ddl)
+    # 旧库的 release_year 是普通列（table_xinfo 的 hidden 为 0）：重建 movies 表改成生成列，
+    # 索引随旧表删除，下面会重新创建
+    year_col = [r for r in cur.execute("PRAGMA table_xinfo(movies);") if r["name"] == "release_year"]
+    if year_col and year_col[0]["hidden"] == 0:
+        cur.execute("BEGIN;")
+        cur.execute("ALTER TABLE movies RENAME TO movies_old;")
+        cur.execute(movies_ddl)
+        cur.execute("""
+            INSERT INTO movies
+            (id, title, original_language, release_date,
+             popularity, vote_average, vote_count, overview)
+            SELECT id, title, original_language, release_date,
+                   popularity, vote_average, vote_count, overview
+            FROM movies_old;
+        """)
+        cur.execute("DROP TABLE movies_old;")
+        conn.commit()
 
     cur.execute("""
         CREATE TABLE IF NOT EXISTS templates (
@@ -63,18 +134,32 @@ def init_db():
             content_text TEXT NOT NULL,
             content_markdown TEXT,
             content_html TEXT,
-            active INTEGER DEFAULT 1
+            active INTEGER DEFAULT 1,
+            updated_at TEXT
         );
     """)
+    # 旧库的 templates 表没有 updated_at 列，补上（模板缓存按它判断是否被修改过）
+    template_cols = {r["name"] for r in cur.execute("PRAGMA table_info(templates);")}
+    if "updated_at" not in template_cols:
+        cur.execute("ALTER TABLE templates ADD COLUMN updated_at TEXT;")
 
     cur.execute("""
         CREATE TABLE IF NOT EXISTS saved_queries (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             name TEXT NOT NULL,
             description TEXT,
-            sql_text TEXT NOT NULL
+            sql_text TEXT NOT NULL,
+            param_count INTEGER
         );
     """)
+    # 旧库的 saved_queries 没有 param_count 列：补上，并按 SQL 里 ? 的个数回填
+    query_cols = {r["name"] for r in cur.execute("PRAGMA table_info(saved_queries);")}
+    if "param_count" not in query_cols:
+        cur.execute("ALTER TABLE saved_queries ADD COLUMN param_count INTEGER;")
+        cur.execute("""
+            UPDATE saved_queries
+            SET param_count = length(sql_text) - length(replace(sql_text, '?', ''));
+        """)
 
     cur.execute("""
         CREATE TABLE IF NOT EXISTS generated_reports (
@@ -88,59 +173,241 @@ def init_db():
         );
     """)
 
-    # 所有表创建完成后再提交并关闭连接
+    # 电影表的汇总统计（单行），导入/新增数据后刷新
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS movie_stats (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            movie_count INTEGER,
+            max_popularity REAL,
+            popularity_p70 REAL,
+            updated_at TEXT
+        );
+    """)
+
+    # 按语言的汇总（每种语言一行），导入/新增数据后整表重建
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS language_summary (
+            original_language TEXT,
+            movie_count INTEGER,
+            avg_rating REAL,
+            avg_popularity REAL,
+            total_votes INTEGER
+        );
+    """)
+
+    # 常用查询条件上的索引
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_movies_popularity ON movies(popularity);")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_movies_release_year ON movies(release_year);")
+    # 按年份取 Top N（year_hot）可直接走索引顺序，无需排序
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_movies_year_pop ON movies(release_year, popularity DESC);")
+    # 高分推荐（high_rated / potential）按评分、票数排序取前 N，可按索引顺序提前结束
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_movies_rating ON movies(vote_average DESC, vote_count DESC);")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_movies_lang_rating "
+                "ON movies(original_language, vote_average DESC, vote_count DESC);")
+    # 时间段统计（period_stats）按 release_date 范围筛选，popularity 直接从索引取
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_movies_release_pop ON movies(release_date, popularity DESC);")
+    # 以上组合索引的首列已覆盖这些单列索引，旧库里的删掉，省去写入时的维护开销
+    cur.execute("DROP INDEX IF EXISTS idx_movies_release_date;")
+    cur.execute("DROP INDEX IF EXISTS idx_movies_vote_average;")
+    cur.execute("DROP INDEX IF EXISTS idx_movies_lang;")
+    # 报告列表按生成时间倒序分页，直接按索引顺序取一页
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_reports_gen ON generated_reports(generated_at DESC, id DESC);")
+
+    # 所有表创建完成后统一提交
     conn.commit()
-    conn.close()
+    # 收集索引统计信息，让 ORDER BY ... LIMIT 查询走索引而不是全表排序
+    cur.execute("ANALYZE;")
+
+# CSV 中 release_date 可能出现的日期格式，按顺序尝试
+MOVIE_DATE_FORMATS = ("%d-%m-%Y", "%Y-%m-%d", "%Y/%m/%d")
+
+MOVIE_INSERT_SQL = """
+    INSERT INTO movies
+    (title, original_language, release_date,
+     popularity, vote_average, vote_count, overview)
+    VALUES (?, ?, ?, ?, ?, ?, ?);
+"""
+
+
+def _text(v):
+    """CSV 空字符串记为 NULL。"""
+    return v if v else None
+
+
+def _parse_date(v):
+    """按 MOVIE_DATE_FORMATS 解析日期，统一成 YYYY-MM-DD，解析不了返回 None。"""
+    if not v:
+        return None
+    for fmt in MOVIE_DATE_FORMATS:
+        try:
+            return datetime.strptime(v, fmt).strftime("%Y-%m-%d")
+        except ValueError:
+            continue
+    return None
 
-def import_movies_from_csv_pandas():
-    """从 CSV 导入电影数据（会清空原 movies 表）。"""
-    if not os.path.exists(MOVIES_CSV_PATH):
-        return False, f"CSV file not found: {MOVIES_CSV_PATH}"
 
+def _float(v):
+    """转成浮点数，空值或非法值返回 None。"""
     try:
-        df = pd.read_csv(MOVIES_CSV_PATH)
-    except Exception as e:
-        return False, f"Error reading CSV: {e}"
+        x = float(v)
+    except (TypeError, ValueError):
+        return None
+    return x if x == x else None  # 排除 NaN
 
-    def parse_date(x):
-        if pd.isna(x):
-            return pd.NaT
-        for fmt in ("%d-%m-%Y", "%Y-%m-%d", "%Y/%m/%d"):
-            try:
-                return pd.to_datetime(x, format=fmt)
-            except Exception:
-                continue
-        return pd.NaT
 
-    if "release_date" not in df.columns:
-        return False, "Column 'release_date' not found in CSV."
+def _int(v):
+    """转成整数（兼容 "12.0" 这类写法），空值或非法值返回 None。"""
+    x = _float(v)
+    try:
+        return int(x) if x is not None else None
+    except OverflowError:
+        return None
 
-    df["release_date"] = df["release_date"].apply(parse_date)
-    df["release_year"] = df["release_date"].dt.year
 
-    numeric_cols = [c for c in ["popularity", "vote_average", "vote_count"] if c in df.columns]
-    if numeric_cols:
-        df[numeric_cols] = df[numeric_cols].apply(pd.to_numeric, errors="coerce")
+def _strict_int(v):
+    """表单用的整数转换：只接受整数写法（"12.7"、"1e3" 都算非法），非法返回 None。"""
+    try:
+        return int(v)
+    except (TypeError, ValueError):
+        return None
 
-    df["release_date"] = df["release_date"].dt.strftime("%Y-%m-%d")
 
-    required_cols = ["title", "original_language", "release_date",
-                     "release_year", "popularity", "vote_average",
-                     "vote_count", "overview"]
-    for col in required_cols:
-        if col not in df.columns:
-            df[col] = pd.NA
+# 新增电影表单里的数值字段及其转换函数（留空记为 NULL）；
+# 表单是用户手填的，整数字段不像 CSV 导入那样宽松
+MOVIE_FORM_NUMBERS = {
+    "popularity": _float,
+    "vote_average": _float,
+    "vote_count": _strict_int,
+}
 
-    df = df[required_cols]
 
-    conn = get_connection()
+def refresh_movie_stats(conn):
+    """重新计算 movie_stats 中的汇总值（电影数、最高人气、人气 70% 分位阈值）。"""
     cur = conn.cursor()
-    cur.execute("DELETE FROM movies;")
+    cur.execute("""
+        SELECT
+            (SELECT COUNT(*) FROM movies) AS movie_count,
+            (SELECT MAX(popularity) FROM movies) AS max_popularity,
+            -- 升序第 70% 位置的 popularity 作为“前 30% 热门”的阈值（OFFSET 从0开始）
+            (SELECT popularity
+             FROM movies
+             WHERE popularity IS NOT NULL
+             ORDER BY popularity ASC
+             LIMIT 1 OFFSET (SELECT ROUND(COUNT(popularity) * 0.7) FROM movies)
+            ) AS popularity_p70;
+    """)
+    row = cur.fetchone()
+    cur.execute("""
+        INSERT OR REPLACE INTO movie_stats
+        (id, movie_count, max_popularity, popularity_p70, updated_at)
+        VALUES (1, ?, ?, ?, datetime('now','localtime'));
+    """, (row["movie_count"], row["max_popularity"], row["popularity_p70"]))
     conn.commit()
+    return row
+
 
-    df.to_sql("movies", conn, if_exists="append", index=False)
-    conn.close()
-    return True, f"Imported {len(df)} movies from CSV."
+def refresh_language_summary(conn):
+    """按语言重新汇总电影数、平均评分、平均人气和总票数，整表重建 language_summary。"""
+    cur = conn.cursor()
+    cur.execute("BEGIN;")
+    cur.execute("DELETE FROM language_summary;")
+    cur.execute("""
+        INSERT INTO language_summary
+        (original_language, movie_count, avg_rating, avg_popularity, total_votes)
+        SELECT original_language,
+               COUNT(*),
+               AVG(vote_average),
+               AVG(popularity),
+               SUM(vote_count)
+        FROM movies
+        GROUP BY original_language;
+    """)
+    conn.commit()
+
+
+def refresh_overview_cache(conn):
+    """重新计算概况页的汇总数据（总数、语言数、平均评分/人气、Top 5），缓存到 app.config。"""
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT COUNT(*) AS cnt,
+               COUNT(DISTINCT original_language) AS lc,
+               AVG(CASE WHEN popularity IS NOT NULL THEN vote_average END) AS ar,
+               AVG(CASE WHEN vote_average IS NOT NULL THEN popularity END) AS ap
+        FROM movies;
+    """)
+    row = cur.fetchone()
+    cur.execute("""
+        SELECT title, vote_average, popularity
+        FROM movies
+        ORDER BY popularity DESC
+        LIMIT 5;
+    """)
+    overview = {
+        "total_movies": row["cnt"] or 0,
+        "language_count": row["lc"] or 0,
+        "avg_rating": row["ar"] or 0,
+        "avg_popularity": row["ap"] or 0,
+        "top5": cur.fetchall(),
+    }
+    app.config["OVERVIEW_CACHE"] = overview
+    return overview
+
+
+def import_movies_from_csv_pandas():
+    """从 CSV 导入电影数据（会清空原 movies 表）。"""
+    if not os.path.exists(MOVIES_CSV_PATH):
+        return False, f"CSV file not found: {MOVIES_CSV_PATH}"
+
+    try:
+        f = open(MOVIES_CSV_PATH, newline="", encoding="utf-8-sig")
+    except OSError as e:
+        return False, f"Error reading CSV: {e}"
+
+    # 表头检查和导入都放在 with 里，任何一步提前返回或出错都会关闭文件
+    with f:
+        try:
+            rdr = csv.DictReader(f)
+            columns = rdr.fieldnames or []
+        except Exception as e:
+            return False, f"Error reading CSV: {e}"
+
+        if "release_date" not in columns:
+            return False, "Column 'release_date' not found in CSV."
+
+        def gen():
+            for r in rdr:
+                yield (_text(r.get("title")), _text(r.get("original_language")),
+                       _parse_date(r.get("release_date")),
+                       _float(r.get("popularity")), _float(r.get("vote_average")),
+                       _int(r.get("vote_count")), _text(r.get("overview")))
+
+        conn = get_connection()
+        cur = conn.cursor()
+        # 导入期间关闭同步，清空 + 插入放在同一个事务里；
+        # 逐行读取直接交给 executemany，不在内存里攒整张表
+        # （库已是 WAL 模式，不再切换 journal_mode，否则会把 WAL 关掉）
+        cur.execute("PRAGMA synchronous=OFF;")
+        try:
+            cur.execute("BEGIN;")
+            cur.execute("DELETE FROM movies;")
+            cur.executemany(MOVIE_INSERT_SQL, gen())
+            total = cur.rowcount
+            conn.commit()
+            refresh_movie_stats(conn)
+            refresh_language_summary(conn)
+            refresh_overview_cache(conn)
+            clear_report_cache()
+            # 数据整体替换后更新统计信息，让查询规划器选对索引
+            cur.execute("ANALYZE movies;")
+        except sqlite3.Error as e:
+            conn.rollback()
+            return False, f"Error importing CSV: {e}"
+        except Exception as e:
+            conn.rollback()
+            return False, f"Error reading CSV: {e}"
+        finally:
+            cur.execute("PRAGMA synchronous=NORMAL;")
+    return True, f"Imported {total} movies from CSV."
 
 
 # ================== 默认模板 & 查询 ==================
@@ -287,63 +554,139 @@ def insert_default_templates_and_queries():
     conn = get_connection()
     cur = conn.cursor()
 
+    # 模板和查询在同一个事务里各用一条 executemany 插入
+    cur.execute("BEGIN;")
+
     # templates
     cur.execute("SELECT COUNT(*) FROM templates;")
     count_t = cur.fetchone()[0]
     if count_t == 0:
-        for t in DEFAULT_TEMPLATES:
-            cur.execute("""
-                INSERT INTO templates
-                (name, topic, description, content_text, content_markdown, content_html, active)
-                VALUES (?, ?, ?, ?, ?, ?, 1);
-            """, (
-                t["name"], t["topic"], t["description"],
-                t["content_text"], t["content_markdown"], t["content_html"]
-            ))
+        template_rows = [
+            (t["name"], t["topic"], t["description"],
+             t["content_text"], t["content_markdown"], t["content_html"])
+            for t in DEFAULT_TEMPLATES
+        ]
+        cur.executemany("""
+            INSERT INTO templates
+            (name, topic, description, content_text, content_markdown, content_html, active, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, 1, strftime('%Y-%m-%d %H:%M:%f', 'now', 'localtime'));
+        """, template_rows)
 
     # saved_queries
     cur.execute("SELECT COUNT(*) FROM saved_queries;")
     count_q = cur.fetchone()[0]
     if count_q == 0:
-        for q in DEFAULT_QUERIES:
-            cur.execute("""
-                INSERT INTO saved_queries (name, description, sql_text)
-                VALUES (?, ?, ?);
-            """, (q["name"], q["description"], q["sql"]))
+        # 插入时就数好每条 SQL 的参数个数，执行时不用再扫描 SQL 文本
+        query_rows = [(q["name"], q["description"], q["sql"], q["sql"].count("?"))
+                      for q in DEFAULT_QUERIES]
+        cur.executemany("""
+            INSERT INTO saved_queries (name, description, sql_text, param_count)
+            VALUES (?, ?, ?, ?);
+        """, query_rows)
 
     conn.commit()
-    conn.close()
+    clear_template_topics()
+    clear_report_cache()
+
+
+class SafeDict(dict):
+    """format_map 用的映射：模板里有但没传值的占位符显示为 N/A。"""
+
+    def __missing__(self, key):
+        return "N/A"
+
+
+def _template_fields(html):
+    """解析模板里用到的占位符名（随模板缓存，只解析一次）。"""
+    try:
+        return frozenset(
+            name.split(".")[0].split("[")[0]
+            for _, name, _, _ in string.Formatter().parse(html or "")
+            if name
+        )
+    except ValueError:
+        # 模板语法有误时留到渲染时再报错
+        return frozenset()
+
+
+# 解析过的 HTML 模板缓存：(template_id, updated_at) -> (content_html, 占位符名集合)
+# 模板被编辑后 updated_at 变化，键随之变化
+_TEMPLATE_CACHE = {}
+# 多线程运行时，淘汰旧版本和写入新版本要一起做（同 _REPORT_CACHE_LOCK）
+_TEMPLATE_CACHE_LOCK = threading.Lock()
+# topic -> 当前启用模板的 (template_id, updated_at)，省去每次渲染查一次 templates 表；
+# 模板有改动时由 clear_template_topics 清空
+_TEMPLATE_TOPICS = {}
+
+
+def clear_template_topics():
+    """模板被编辑、新增或重建表结构后调用，下次渲染时重新查 topic 对应的模板。"""
+    _TEMPLATE_TOPICS.clear()
 
 
 def render_template_html(topic, **kwargs):
-    """从 templates 表中取 HTML 模板并 format。"""
+    """取 topic 对应的启用模板并 format；模板内容按 (id, updated_at) 缓存，只在模板变化时重新读取和解析。"""
     conn = get_connection()
     cur = conn.cursor()
-    cur.execute("""
-        SELECT id, content_html
-        FROM templates
-        WHERE topic = ? AND active = 1
-        LIMIT 1;
-    """, (topic,))
-    row = cur.fetchone()
-    conn.close()
-    if not row:
-        return None, "[ERROR] No active HTML template found.", None
-    tpl_id = row["id"]
-    html = row["content_html"]
-
-    safe_kwargs = {}
-    for k, v in kwargs.items():
-        safe_kwargs[k] = "N/A" if v is None else v
-
+    key = _TEMPLATE_TOPICS.get(topic)
+    if key is None:
+        cur.execute("""
+            SELECT id, updated_at
+            FROM templates
+            WHERE topic = ? AND active = 1
+            ORDER BY id
+            LIMIT 1;
+        """, (topic,))
+        row = cur.fetchone()
+        if not row:
+            return None, "[ERROR] No active HTML template found.", None
+        key = _TEMPLATE_TOPICS[topic] = (row["id"], row["updated_at"])
+    tpl_id = key[0]
+    cached = _TEMPLATE_CACHE.get(key)
+    if cached is None:
+        cur.execute("SELECT content_html FROM templates WHERE id = ?;", (tpl_id,))
+        html = cur.fetchone()["content_html"]
+        cached = (html, _template_fields(html))
+        with _TEMPLATE_CACHE_LOCK:
+            # 同一模板的旧版本不再需要
+            for old_key in [k for k in _TEMPLATE_CACHE if k[0] == tpl_id]:
+                del _TEMPLATE_CACHE[old_key]
+            _TEMPLATE_CACHE[key] = cached
+    html, fields = cached
+
+    # 只取模板用得到的参数；None 和没传的占位符都显示 N/A
+    values = SafeDict(
+        (k, "N/A" if kwargs[k] is None else kwargs[k]) for k in fields if k in kwargs
+    )
     try:
-        rendered = html.format(** safe_kwargs)
-    except KeyError as e:
-        missing = e.args[0]
-        return None, f"[TEMPLATE ERROR] missing placeholder {missing}", None
+        rendered = html.format_map(values)
+    except (KeyError, IndexError, AttributeError, ValueError) as e:
+        return None, f"[TEMPLATE ERROR] {e}", None
     return tpl_id, rendered, None
 
 
+# 报告 HTML 缓存：(报告类型, 筛选参数...) -> (template_id, html)
+# 电影数据或模板有改动时整体清空（见 clear_report_cache 的调用处）
+REPORT_CACHE_SIZE = 128
+_REPORT_CACHE = {}
+# 多线程运行时，检查上限、淘汰、写入要一起做，避免两个线程淘汰同一条
+_REPORT_CACHE_LOCK = threading.Lock()
+
+
+def cache_report(key, template_id, html_content):
+    """缓存一份生成好的报告，超过上限时丢掉最早放进来的一条。"""
+    with _REPORT_CACHE_LOCK:
+        if key not in _REPORT_CACHE and len(_REPORT_CACHE) >= REPORT_CACHE_SIZE:
+            _REPORT_CACHE.pop(next(iter(_REPORT_CACHE)), None)
+        _REPORT_CACHE[key] = (template_id, html_content)
+
+
+def clear_report_cache():
+    """电影数据或模板改动后调用，丢弃所有已缓存的报告。"""
+    with _REPORT_CACHE_LOCK:
+        _REPORT_CACHE.clear()
+
+
 def save_report(template_id, parameters, html_content):
     conn = get_connection()
     cur = conn.cursor()
@@ -352,7 +695,27 @@ def save_report(template_id, parameters, html_content):
         VALUES (?, datetime('now','localtime'), 'html', ?, ?);
     """, (template_id, parameters, html_content))
     conn.commit()
-    conn.close()
+
+
+def query_frame(conn, sql, params=()):
+    """执行查询并返回 DataFrame；游标用普通元组行，省掉 sqlite3.Row 的逐行转换。"""
+    cur = conn.cursor()
+    cur.row_factory = None
+    cur.execute(sql, params)
+    columns = [desc[0] for desc in cur.description]
+    return pd.DataFrame.from_records(cur.fetchall(), columns=columns, coerce_float=True)
+
+
+# 影片列表文本中常用的列：(显示名, 列名, 格式)
+POP_RATING_FIELDS = [("popularity", "popularity", "{:.1f}"), ("rating", "vote_average", "{:.1f}")]
+
+
+def _format_movie_lines(df, fields):
+    """把影片 DataFrame 整列拼成编号列表文本，每行形如 "1. 标题 | popularity 12.3 | rating 7.5"，空值显示 N/A。"""
+    lines = pd.Series(range(1, len(df) + 1), index=df.index).astype(str) + ". " + df["title"].astype(str)
+    for label, col, fmt in fields:
+        lines = lines + f" | {label} " + df[col].map(fmt.format, na_action="ignore").fillna("N/A")
+    return "\n".join(lines)
 
 
 # ================== 登录验证装饰器 ==================
@@ -387,9 +750,10 @@ def login():
             (username,)
         )
         user = cur.fetchone()
-        conn.close()
 
-        if user and hashlib.sha256(password.encode()).hexdigest() == user['password_hash']:
+        # 常量时间比较，避免按比较耗时猜测哈希
+        password_hash = hashlib.sha256(password.encode()).hexdigest()
+        if user and hmac.compare_digest(password_hash, user['password_hash']):
             session['user_id'] = user['id']
             session['username'] = username
             next_page = request.args.get('next', url_for('index'))
@@ -432,8 +796,6 @@ def register():
         except sqlite3.IntegrityError:
             flash('The username already exists', 'danger')
             return redirect(url_for('register'))
-        finally:
-            conn.close()
 
     return render_template('register.html')
 
@@ -471,42 +833,9 @@ def index():
 @app.route("/overview")
 @login_required
 def overview():
-    conn = get_connection()
-    cur = conn.cursor()
-
-    cur.execute("SELECT COUNT(*) AS cnt FROM movies;")
-    total_movies = cur.fetchone()["cnt"] or 0
-
-    cur.execute("SELECT COUNT(DISTINCT original_language) AS lc FROM movies;")
-    language_count = cur.fetchone()["lc"] or 0
-
-    cur.execute("""
-        SELECT AVG(vote_average) AS ar, AVG(popularity) AS ap
-        FROM movies
-        WHERE vote_average IS NOT NULL AND popularity IS NOT NULL;
-    """)
-    row = cur.fetchone()
-    avg_rating = row["ar"] or 0
-    avg_popularity = row["ap"] or 0
-
-    cur.execute("""
-        SELECT title, vote_average, popularity
-        FROM movies
-        ORDER BY popularity DESC
-        LIMIT 5;
-    """)
-    top5 = cur.fetchall()
-    conn.close()
-
-    return render_template(
-        "overview.html",
-        total_movies=total_movies,
-        language_count=language_count,
-        avg_rating=avg_rating,
-        avg_popularity=avg_popularity,
-        top5=top5,
-        report_text=None
-    )
+    # 数据只在导入/新增时变化，概况直接读缓存，缓存缺失时再现算
+    cached = app.config.get("OVERVIEW_CACHE") or refresh_overview_cache(get_connection())
+    return render_template("overview.html", report_text=None, **cached)
 
 
 # ================== B. 热门影片统计与分析 ==================
@@ -516,69 +845,48 @@ def hot_menu():
     conn = get_connection()
     cur = conn.cursor()
 
-    # 1. 获取今年最热门影片（按 popularity 降序取第一）
+    # 1. 一条查询取齐所有标量统计：今年最热门影片、历史最高人气值、
+    #    前 30% 热门的人气阈值（读导入时算好的 movie_stats）以及阈值以上影片的平均评分
     current_year = datetime.now().year  # 需要导入 datetime 模块
+    summary_sql = """
+                SELECT (SELECT title
+                        FROM movies
+                        WHERE release_year = ?
+                          AND popularity IS NOT NULL
+                        ORDER BY popularity DESC LIMIT 1) AS top_title,
+                       s.id AS stats_id,
+                       s.max_popularity,
+                       (SELECT AVG(vote_average)
+                        FROM movies
+                        WHERE vote_average IS NOT NULL
+                          AND popularity IS NOT NULL
+                          AND popularity > COALESCE(s.popularity_p70, 0)) AS avg_rating
+                FROM (SELECT 1)
+                LEFT JOIN movie_stats s ON s.id = 1;
+                """
+    summary = cur.execute(summary_sql, (current_year,)).fetchone()
+    if summary['stats_id'] is None:
+        # movie_stats 还没算过，先补算一次再取
+        refresh_movie_stats(conn)
+        summary = cur.execute(summary_sql, (current_year,)).fetchone()
+
+    top_movie_title = summary['top_title'] or "暂无数据"
+    max_popularity = round(summary['max_popularity'], 1) if summary['max_popularity'] else 0
+    avg_rating = round(summary['avg_rating'], 1) if summary['avg_rating'] is not None else 0
+
+    # 2. 获取每月平均人气值（用于趋势图），一次 GROUP BY 取出 12 个月
     cur.execute("""
-                SELECT title
+                SELECT CAST(strftime('%m', release_date) AS INTEGER) AS m,
+                       AVG(popularity) AS avg_pop
                 FROM movies
-                WHERE release_year = ?
-                  AND popularity IS NOT NULL
-                ORDER BY popularity DESC LIMIT 1;
-                """, (current_year,))
-    top_movie = cur.fetchone()
-    top_movie_title = top_movie['title'] if top_movie else "暂无数据"
-
-    # 2. 获取历史最高人气值
-    cur.execute("SELECT MAX(popularity) AS max_pop FROM movies WHERE popularity IS NOT NULL;")
-    max_pop_row = cur.fetchone()
-    max_popularity = round(max_pop_row['max_pop'], 1) if max_pop_row['max_pop'] else 0
-
-    # 3. 获取热门影片平均评分（可按 popularity 前30%筛选）
-    cur.execute("""
-                -- 步骤1：筛选有 popularity 值的影片并排序
-                WITH ranked_movies AS (SELECT popularity
-                                       FROM movies
-                                       WHERE popularity IS NOT NULL
-                                       ORDER BY popularity ASC -- 升序排序，方便取偏移量
-                ),
-                     -- 步骤2：计算总记录数
-                     total_count AS (SELECT COUNT(*) AS cnt
-                                     FROM ranked_movies)
-                -- 步骤3：取 70% 位置的 popularity 作为阈值（OFFSET 从0开始）
-                SELECT popularity
-                FROM ranked_movies,
-                     total_count LIMIT 1
-                OFFSET (SELECT CASE WHEN cnt = 0 THEN 0 ELSE ROUND(cnt * 0.7) END FROM total_count);
+                WHERE popularity IS NOT NULL
+                  AND release_date IS NOT NULL
+                GROUP BY m
+                HAVING m IS NOT NULL;
                 """)
-    threshold_row = cur.fetchone()
-    # 处理无数据的情况
-    threshold = threshold_row['popularity'] if (threshold_row and threshold_row['popularity'] is not None) else 0
-
-    # 3.2 用阈值筛选前 30% 热门影片，计算平均评分
-    cur.execute("""
-                SELECT AVG(vote_average) AS avg_rating
-                FROM movies
-                WHERE vote_average IS NOT NULL
-                  AND popularity IS NOT NULL
-                  AND popularity > ?; -- 使用上面计算的阈值
-                """, (threshold,))  # 传递阈值作为参数
-    avg_rating_row = cur.fetchone()
-    avg_rating = round(avg_rating_row['avg_rating'], 1) if (
-                avg_rating_row and avg_rating_row['avg_rating'] is not None) else 0
-
-    # 4. 获取每月平均人气值（用于趋势图）
-    monthly_avg = []
-    for month in range(1, 13):
-        cur.execute("""
-                    SELECT AVG(popularity) AS avg_pop
-                    FROM movies
-                    WHERE popularity IS NOT NULL
-                      AND strftime('%m', release_date) = ?
-                    """, (f"{month:02d}",))
-        row = cur.fetchone()
-        monthly_avg.append(round(row['avg_pop'], 1) if row['avg_pop'] else 0)
+    by_month = {r['m']: r['avg_pop'] for r in cur.fetchall()}
+    monthly_avg = [round(by_month.get(m) or 0, 1) for m in range(1, 13)]
 
-    conn.close()
 
     # 将数据传递给模板
     return render_template(
@@ -628,48 +936,33 @@ def hot_topn():
 
     where_sql = " AND ".join(where) if where else "1=1"
 
+    # Top N 与汇总统计一次查出：窗口函数在 LIMIT 之前对全部匹配行计算；
+    # 窗口按 popularity 排序、框住整个分区，规划器可沿索引顺序读取，不再额外排序
     conn = get_connection()
-    cur = conn.cursor()
-    cur.execute(f"""
-        SELECT COUNT(*) AS cnt, AVG(vote_average) AS ar, AVG(popularity) AS ap
+    top_df = query_frame(conn, f"""
+        SELECT title, popularity, vote_average,
+               COUNT(vote_average) OVER w AS cnt,
+               AVG(vote_average) OVER w AS ar,
+               AVG(CASE WHEN vote_average IS NOT NULL THEN popularity END) OVER w AS ap
         FROM movies
         WHERE {where_sql}
           AND popularity IS NOT NULL
-          AND vote_average IS NOT NULL;
-    """, params)
-    row = cur.fetchone()
-    total_movies = row["cnt"]
+        WINDOW w AS (ORDER BY popularity DESC ROWS BETWEEN UNBOUNDED PRECEDING AND UNBOUNDED FOLLOWING)
+        ORDER BY popularity DESC
+        LIMIT ?;
+    """, params + [n])
+    total_movies = int(top_df["cnt"].iat[0]) if len(top_df) else 0
     if not total_movies:
-        conn.close()
         flash("No movies found for selected range.", "warning")
         return redirect(url_for("hot_topn"))
-    avg_rating = row["ar"] or 0
-    avg_pop = row["ap"] or 0
+    avg_rating = float(top_df["ar"].iat[0])
+    avg_pop = float(top_df["ap"].iat[0])
 
-    cur.execute(f"""
-        SELECT title, popularity, vote_average
-        FROM movies
-        WHERE {where_sql}
-          AND popularity IS NOT NULL
-        ORDER BY popularity DESC
-        LIMIT ?;
-    """, params + [n])
-    rows = cur.fetchall()
-    conn.close()
-
-    lines = []
-    for i, r in enumerate(rows, start=1):
-        title = r["title"]
-        pop = r["popularity"]
-        rating = r["vote_average"]
-        pop_str = f"{pop:.1f}" if pop is not None else "N/A"
-        rating_str = f"{rating:.1f}" if rating is not None else "N/A"
-        lines.append(f"{i}. {title} | popularity {pop_str} | rating {rating_str}")
-    movie_list = "\n".join(lines)
+    movie_list = _format_movie_lines(top_df, POP_RATING_FIELDS)
 
     tpl_id, html_report, err = render_template_html(
         "top_n_popular",
-        n=len(rows),
+        n=len(top_df),
         time_desc=time_desc,
         total_movies=total_movies,
         avg_rating=avg_rating,
@@ -705,43 +998,29 @@ def year_hot():
         return redirect(url_for("year_hot"))
 
     year = int(year_str)
+    # Top N 与汇总统计一次查出：窗口函数在 LIMIT 之前对全部匹配行计算；
+    # 窗口按 popularity 排序、框住整个分区，规划器可沿索引顺序读取，不再额外排序
     conn = get_connection()
-    cur = conn.cursor()
-    cur.execute("""
-        SELECT COUNT(*) AS cnt, AVG(vote_average) AS ar, AVG(popularity) AS ap
+    top_df = query_frame(conn, """
+        SELECT title, popularity, vote_average,
+               COUNT(vote_average) OVER w AS cnt,
+               AVG(vote_average) OVER w AS ar,
+               AVG(CASE WHEN vote_average IS NOT NULL THEN popularity END) OVER w AS ap
         FROM movies
         WHERE release_year = ?
-          AND vote_average IS NOT NULL
-          AND popularity IS NOT NULL;
-    """, (year,))
-    row = cur.fetchone()
-    movie_count = row["cnt"]
+          AND popularity IS NOT NULL
+        WINDOW w AS (ORDER BY popularity DESC ROWS BETWEEN UNBOUNDED PRECEDING AND UNBOUNDED FOLLOWING)
+        ORDER BY popularity DESC
+        LIMIT ?;
+    """, (year, n))
+    movie_count = int(top_df["cnt"].iat[0]) if len(top_df) else 0
     if not movie_count:
-        conn.close()
         flash("No movies found for this year.", "warning")
         return redirect(url_for("year_hot"))
-    avg_rating = row["ar"] or 0
-    avg_pop = row["ap"] or 0
+    avg_rating = float(top_df["ar"].iat[0])
+    avg_pop = float(top_df["ap"].iat[0])
 
-    cur.execute("""
-        SELECT title, popularity, vote_average
-        FROM movies
-        WHERE release_year = ?
-        ORDER BY popularity DESC
-        LIMIT ?;
-    """, (year, n))
-    rows = cur.fetchall()
-    conn.close()
-
-    lines = []
-    for i, r in enumerate(rows, start=1):
-        title = r["title"]
-        pop = r["popularity"]
-        rating = r["vote_average"]
-        pop_str = f"{pop:.1f}" if pop is not None else "N/A"
-        rating_str = f"{rating:.1f}" if rating is not None else "N/A"
-        lines.append(f"{i}. {title} | popularity {pop_str} | rating {rating_str}")
-    top_n_list = "\n".join(lines)
+    top_n_list = _format_movie_lines(top_df, POP_RATING_FIELDS)
 
     tpl_id, html_report, err = render_template_html(
         "year_top_popularity",
@@ -749,7 +1028,7 @@ def year_hot():
         movie_count=movie_count,
         avg_rating=avg_rating,
         avg_popularity=avg_pop,
-        n=len(rows),
+        n=len(top_df),
         top_n_list=top_n_list
     )
     if not tpl_id:
@@ -794,55 +1073,36 @@ def potential():
     except ValueError:
         max_popularity = 200.0
 
+    # 1. 取代表影片列表（Top 50），编号和每行文本直接在 SQL 里用 printf 拼好，
+    #    同时用窗口函数统计符合条件的影片总数
     conn = get_connection()
     cur = conn.cursor()
-
-    # 1. 汇总统计：符合条件的影片数量 & 平均评分
     cur.execute("""
-        SELECT COUNT(*) AS cnt, AVG(vote_average) AS ar
-        FROM movies
-        WHERE vote_average >= ?
-          AND popularity IS NOT NULL
-          AND popularity <= ?;
+        SELECT printf('%d. %s | rating %.1f | votes %s | popularity %.1f',
+                      rn, title, vote_average, COALESCE(vote_count, 'N/A'), popularity) AS line,
+               cnt
+        FROM (
+            SELECT title, vote_average, vote_count, popularity,
+                   ROW_NUMBER() OVER (ORDER BY vote_average DESC, vote_count DESC) AS rn,
+                   COUNT(*) OVER () AS cnt
+            FROM movies
+            WHERE vote_average >= ?
+              AND popularity IS NOT NULL
+              AND popularity <= ?
+        )
+        WHERE rn <= 50
+        ORDER BY rn;
     """, (min_rating, max_popularity))
-    row = cur.fetchone()
-    movie_count = row["cnt"]
+    rows = cur.fetchall()
+    movie_count = rows[0]["cnt"] if rows else 0
     if not movie_count:
-        conn.close()
         flash("Under the current conditions, no potential films have been found (high scores but low popularity)", "warning")
         return redirect(url_for("potential"))
 
-    avg_rating = row["ar"] or 0
+    # 2. 组装英文列表文本 movie_list，给模板用
+    movie_list = "\n".join(r["line"] for r in rows)
 
-    # 2. 取代表影片列表（Top 50）
-    cur.execute("""
-        SELECT title, vote_average, vote_count, popularity
-        FROM movies
-        WHERE vote_average >= ?
-          AND popularity IS NOT NULL
-          AND popularity <= ?
-        ORDER BY vote_average DESC, vote_count DESC
-        LIMIT 50;
-    """, (min_rating, max_popularity))
-    rows = cur.fetchall()
-    conn.close()
-
-    # 3. 组装英文列表文本 movie_list，给模板用
-    lines = []
-    for i, r in enumerate(rows, start=1):
-        title = r["title"]
-        rating = r["vote_average"]
-        votes = r["vote_count"]
-        pop = r["popularity"]
-
-        rating_str = f"{rating:.1f}" if rating is not None else "N/A"
-        pop_str = f"{pop:.1f}" if pop is not None else "N/A"
-        lines.append(
-            f"{i}. {title} | rating {rating_str} | votes {votes} | popularity {pop_str}"
-        )
-    movie_list = "\n".join(lines)
-
-    # 4. 用 topic='hidden_gems' 的英文 HTML 模板生成报告
+    # 3. 用 topic='hidden_gems' 的英文 HTML 模板生成报告
     tpl_id, html_report, err = render_template_html(
         "hidden_gems",
         min_rating=min_rating,
@@ -856,11 +1116,11 @@ def potential():
         flash(html_report, "danger")
         return redirect(url_for("potential"))
 
-    # 5. 保存报告到 generated_reports 表
+    # 4. 保存报告到 generated_reports 表
     param_desc = f"hidden_gems | rating>={min_rating} | pop<={max_popularity}"
     save_report(tpl_id, param_desc, html_report)
 
-    # 6. 在网页上展示英文报告
+    # 5. 在网页上展示英文报告
     return render_template(
         "report.html",
         title="Potential Hidden Gems",
@@ -923,7 +1183,7 @@ def movie_search():
     """
     query_params.append(params['limit'])
     cur.execute(sql, query_params)
-    movies = [dict(row) for row in cur.fetchall()]
+    movies = cur.fetchall()  # 模板里按 m["title"] 取值，sqlite3.Row 可直接用
 
     # 统计信息
     stats = None
@@ -939,7 +1199,6 @@ def movie_search():
         result= cur.fetchone()
         stats= dict(result) if result else None
 
-    conn.close()
 
     return render_template(
         'movie_search_results.html',
@@ -948,6 +1207,38 @@ def movie_search():
         stats=stats
     )
 
+# 高分推荐（high_rated）的查询：按是否筛选语言分成两条固定 SQL，请求时不再拼 WHERE。
+# 总数 / 平均评分和 Top 50 一次取出；窗口与外层排序一致，仍可按索引顺序取前 50 条；
+# 每行文本直接在 SQL 里用 printf 拼好
+_HIGH_RATED_SQL_TEMPLATE = """
+    WITH ranked AS (
+        SELECT printf('%d. %s | rating %.1f | votes %s | popularity %s',
+                      ROW_NUMBER() OVER w, title, vote_average, vote_count,
+                      CASE WHEN popularity IS NULL THEN 'N/A'
+                           ELSE printf('%.1f', popularity) END) AS line,
+               COUNT(*) OVER w AS cnt,
+               AVG(vote_average) OVER w AS ar
+        FROM movies
+        WHERE {where}
+        WINDOW w AS (ORDER BY vote_average DESC, vote_count DESC
+                     ROWS BETWEEN UNBOUNDED PRECEDING AND UNBOUNDED FOLLOWING)
+        ORDER BY vote_average DESC, vote_count DESC
+        LIMIT 50
+    )
+    -- 注意：group_concat 本身不保证拼接顺序，这里依赖 SQLite 按 ranked 的
+    -- ORDER BY ... LIMIT 输出顺序喂给聚合（3.40 实测成立）。升级到 SQLite 3.44+ 后
+    -- 应改成 group_concat(line, char(10) ORDER BY ...) 显式排序
+    SELECT group_concat(line, char(10)) AS movie_list,
+           MAX(cnt) AS cnt,
+           MAX(ar) AS ar
+    FROM ranked;
+"""
+HIGH_RATED_SQL = _HIGH_RATED_SQL_TEMPLATE.format(
+    where="vote_average >= ? AND vote_count >= ?")
+HIGH_RATED_LANG_SQL = _HIGH_RATED_SQL_TEMPLATE.format(
+    where="vote_average >= ? AND vote_count >= ? AND original_language = ?")
+
+
 @app.route("/recommend/highscore", methods=["GET", "POST"])
 @login_required
 def high_rated():
@@ -967,50 +1258,32 @@ def high_rated():
     except ValueError:
         min_votes = 50
 
-    where = ["vote_average >= ?", "vote_count >= ?"]
-    params = [min_rating, min_votes]
+    params = (min_rating, min_votes)
     language_desc = "All languages"
     if lang:
-        where.append("original_language = ?")
-        params.append(lang)
+        params = (min_rating, min_votes, lang)
         language_desc = f"Only '{lang}'"
-    where_sql = " AND ".join(where)
+    report_params = f"high_rated | min_rating={min_rating} | min_votes={min_votes} | lang={lang}"
+
+    # 同样的筛选条件已经生成过报告（且数据、模板都没变），直接复用
+    report_key = ("high_rated", min_rating, min_votes, lang)
+    cached = _REPORT_CACHE.get(report_key)
+    if cached is not None:
+        tpl_id, html_report = cached
+        save_report(tpl_id, report_params, html_report)
+        return render_template("report.html", title="High-Score Recommendation", report_html=html_report)
 
     conn = get_connection()
     cur = conn.cursor()
-    cur.execute(f"""
-        SELECT COUNT(*) AS cnt, AVG(vote_average) AS ar
-        FROM movies
-        WHERE {where_sql};
-    """, params)
+    cur.execute(HIGH_RATED_LANG_SQL if lang else HIGH_RATED_SQL, params)
+    # 列表文本由 SQL 端 group_concat 拼好，只取回一行
     row = cur.fetchone()
-    movie_count = row["cnt"]
+    movie_count = row["cnt"] or 0
     if not movie_count:
-        conn.close()
         flash("No movies match the filters.", "warning")
         return redirect(url_for("high_rated"))
     avg_rating = row["ar"] or 0
-
-    cur.execute(f"""
-        SELECT title, vote_average, vote_count, popularity
-        FROM movies
-        WHERE {where_sql}
-        ORDER BY vote_average DESC, vote_count DESC
-        LIMIT 50;
-    """, params)
-    rows = cur.fetchall()
-    conn.close()
-
-    lines = []
-    for i, r in enumerate(rows, start=1):
-        title = r["title"]
-        rating = r["vote_average"]
-        votes = r["vote_count"]
-        pop = r["popularity"]
-        rating_str = f"{rating:.1f}" if rating is not None else "N/A"
-        pop_str = f"{pop:.1f}" if pop is not None else "N/A"
-        lines.append(f"{i}. {title} | rating {rating_str} | votes {votes} | popularity {pop_str}")
-    movie_list = "\n".join(lines)
+    movie_list = row["movie_list"]
 
     tpl_id, html_report, err = render_template_html(
         "high_score_recommendation",
@@ -1025,7 +1298,8 @@ def high_rated():
         flash(html_report, "danger")
         return redirect(url_for("high_rated"))
 
-    save_report(tpl_id, f"high_rated | min_rating={min_rating} | min_votes={min_votes} | lang={lang}", html_report)
+    cache_report(report_key, tpl_id, html_report)
+    save_report(tpl_id, report_params, html_report)
     return render_template("report.html", title="High-Score Recommendation", report_html=html_report)
 
 
@@ -1043,40 +1317,39 @@ def language_stats():
     conn = get_connection()
     cur = conn.cursor()
     
-    cur.execute("""
+    # 读导入时汇总好的 language_summary，不再每次对 movies 做 GROUP BY；
+    # 报告里每种语言一行的文本直接在 SQL 里用 printf 拼好（line 列）
+    language_sql = """
         SELECT 
             original_language,
-            COUNT(*) AS movie_count,
-            AVG(vote_average) AS avg_rating,
-            AVG(popularity) AS avg_popularity,
-            SUM(vote_count) AS total_votes
-        FROM movies
-        GROUP BY original_language
+            movie_count,
+            avg_rating,
+            avg_popularity,
+            total_votes,
+            printf('%s: %d movies | avg rating %s | avg popularity %s | total votes %s',
+                   COALESCE(NULLIF(original_language, ''), 'N/A'), movie_count,
+                   CASE WHEN avg_rating IS NULL THEN 'N/A'
+                        ELSE printf('%.2f', avg_rating) END,
+                   CASE WHEN avg_popularity IS NULL THEN 'N/A'
+                        ELSE printf('%.2f', avg_popularity) END,
+                   COALESCE(total_votes, 0)) AS line
+        FROM language_summary
         ORDER BY movie_count DESC;
-    """)
-    stats = cur.fetchall()
+    """
+    stats = cur.execute(language_sql).fetchall()
+    if not stats:
+        # language_summary 还没汇总过，先补算一次再取
+        refresh_language_summary(conn)
+        stats = cur.execute(language_sql).fetchall()
     
     language_count = len(stats)
-    
-    lines = []
-    for row in stats:
-        lang = row['original_language'] or 'N/A'
-        count = row['movie_count']
-        rating = row['avg_rating']
-        pop = row['avg_popularity']
-        votes = row['total_votes'] or 0
-        
-        rating_str = f"{rating:.2f}" if rating is not None else "N/A"
-        pop_str = f"{pop:.2f}" if pop is not None else "N/A"
-        lines.append(f"{lang}: {count} movies | avg rating {rating_str} | avg popularity {pop_str} | total votes {votes}")
-    language_stats_text = "\n".join(lines)
+    language_stats_text = "\n".join(row['line'] for row in stats)
     
     tpl_id, html_report, err = render_template_html(
         "language_structure",
         language_count=language_count,
         language_stats=language_stats_text
     )
-    conn.close()
     
     if err:
         flash(err, "danger")
@@ -1098,6 +1371,10 @@ def period_stats():
     if not start_date or not end_date:
         flash("Please enter the complete date range", "danger")
         return redirect(url_for("period_stats"))
+    # 起止日期颠倒时结果必然为空，不用查库
+    if start_date > end_date:
+        flash("The start date cannot be later than the end date", "danger")
+        return redirect(url_for("period_stats"))
     
     try:
         n = int(n_str)
@@ -1107,46 +1384,54 @@ def period_stats():
         flash("The number of invalid Top N", "danger")
         return redirect(url_for("period_stats"))
     
+    report_params = f"period_stats | {start_date} to {end_date} | N={n}"
+
+    # 同样的时间段和 N 已经生成过报告（且数据、模板都没变），直接复用
+    report_key = ("period_stats", start_date, end_date, n)
+    cached = _REPORT_CACHE.get(report_key)
+    if cached is not None:
+        tpl_id, html_report = cached
+        save_report(tpl_id, report_params, html_report)
+        return render_template("report.html", title="Time Window Performance", report_html=html_report)
+    
     conn = get_connection()
     cur = conn.cursor()
     
+    # 时间段汇总和 Top N 用窗口函数一次取出，每行文本在 SQL 里用 printf 拼好
+    # （评分、人气为 0 或空时显示 N/A），再用 group_concat 合成一段文本只返回一行
     cur.execute("""
-        SELECT 
-            COUNT(*) AS movie_count,
-            AVG(vote_average) AS avg_rating,
-            AVG(popularity) AS avg_popularity
-        FROM movies
-        WHERE release_date BETWEEN ? AND ?;
-    """, (start_date, end_date))
+        WITH ranked AS (
+            SELECT printf('%d. %s | rating %s | popularity %s | released %s',
+                          ROW_NUMBER() OVER w, title,
+                          CASE WHEN vote_average THEN printf('%.1f', vote_average) ELSE 'N/A' END,
+                          CASE WHEN popularity THEN printf('%.1f', popularity) ELSE 'N/A' END,
+                          release_date) AS line,
+                   COUNT(*) OVER w AS movie_count,
+                   AVG(vote_average) OVER w AS avg_rating,
+                   AVG(popularity) OVER w AS avg_popularity
+            FROM movies
+            WHERE release_date BETWEEN ? AND ?
+            WINDOW w AS (ORDER BY popularity DESC
+                         ROWS BETWEEN UNBOUNDED PRECEDING AND UNBOUNDED FOLLOWING)
+            ORDER BY popularity DESC
+            LIMIT ?
+        )
+        -- 注意：group_concat 本身不保证拼接顺序，这里依赖 SQLite 按 ranked 的
+        -- ORDER BY ... LIMIT 输出顺序喂给聚合（3.40 实测成立）。升级到 SQLite 3.44+ 后
+        -- 应改成 group_concat(line, char(10) ORDER BY ...) 显式排序
+        SELECT group_concat(line, char(10)) AS top_n_list,
+               COUNT(*) AS shown,
+               MAX(movie_count) AS movie_count,
+               MAX(avg_rating) AS avg_rating,
+               MAX(avg_popularity) AS avg_popularity
+        FROM ranked;
+    """, (start_date, end_date, n))
     summary = cur.fetchone()
     
-    if not summary['movie_count']:
-        conn.close()
+    if not summary['shown']:
         flash("There is no movie data during this period", "warning")
         return redirect(url_for("period_stats"))
     
-    cur.execute("""
-        SELECT title, vote_average, popularity, release_date
-        FROM movies
-        WHERE release_date BETWEEN ? AND ?
-        ORDER BY popularity DESC
-        LIMIT ?;
-    """, (start_date, end_date, n))
-    movies = cur.fetchall()
-    conn.close()
-    
-    lines = []
-    for i, m in enumerate(movies, 1):
-        title = m['title']
-        rating = m['vote_average']
-        pop = m['popularity']
-        date = m['release_date']
-        
-        rating_str = f"{rating:.1f}" if rating else "N/A"
-        pop_str = f"{pop:.1f}" if pop else "N/A"
-        lines.append(f"{i}. {title} | rating {rating_str} | popularity {pop_str} | released {date}")
-    top_n_list = "\n".join(lines)
-    
     tpl_id, html_report, err = render_template_html(
         "time_window_performance",
         start_date=start_date,
@@ -1154,15 +1439,16 @@ def period_stats():
         movie_count=summary['movie_count'],
         avg_rating=summary['avg_rating'] or 0,
         avg_popularity=summary['avg_popularity'] or 0,
-        n=len(movies),
-        top_n_list=top_n_list
+        n=summary['shown'],
+        top_n_list=summary['top_n_list']
     )
     
-    if err:
-        flash(err, "danger")
+    if not tpl_id:
+        flash(html_report, "danger")
         return redirect(url_for("period_stats"))
     
-    save_report(tpl_id, f"period_stats | {start_date} to {end_date} | N={n}", html_report)
+    cache_report(report_key, tpl_id, html_report)
+    save_report(tpl_id, report_params, html_report)
     return render_template("report.html", title="Time Window Performance", report_html=html_report)
 
 
@@ -1177,17 +1463,21 @@ def reports_menu():
 @app.route("/reports/list")
 @login_required
 def reports_list():
+    page = max(request.args.get("page", 1, type=int), 1)
     conn = get_connection()
     cur = conn.cursor()
+    # 只取当前页（多取一条用来判断有没有下一页），列表不需要报告正文 content
     cur.execute("""
-        SELECT r.*, t.name as template_name
+        SELECT r.id, r.generated_at, r.format, r.parameters, t.name as template_name
         FROM generated_reports r
         LEFT JOIN templates t ON r.template_id = t.id
-        ORDER BY r.generated_at DESC;
-    """)
+        ORDER BY r.generated_at DESC, r.id DESC
+        LIMIT ? OFFSET ?;
+    """, (REPORTS_PAGE_SIZE + 1, (page - 1) * REPORTS_PAGE_SIZE))
     reports = cur.fetchall()
-    conn.close()
-    return render_template("reports_list.html", reports=reports)
+    has_next = len(reports) > REPORTS_PAGE_SIZE
+    return render_template("reports_list.html", reports=reports[:REPORTS_PAGE_SIZE],
+                           page=page, has_next=has_next)
 
 
 @app.route("/reports/detail/<int:report_id>")
@@ -1202,7 +1492,6 @@ def report_detail(report_id):
         WHERE r.id = ?;
     """, (report_id,))
     report = cur.fetchone()
-    conn.close()
     
     if not report:
         flash("The report does not exist.", "danger")
@@ -1218,7 +1507,6 @@ def templates_list():
     cur = conn.cursor()
     cur.execute("SELECT * FROM templates ORDER BY id;")
     templates = cur.fetchall()
-    conn.close()
     return render_template("templates_list.html", templates=templates)
 
 
@@ -1229,7 +1517,6 @@ def sql_list():
     cur = conn.cursor()
     cur.execute("SELECT * FROM saved_queries ORDER BY id;")
     queries = cur.fetchall()
-    conn.close()
     return render_template("sql_list.html", queries=queries)
 
 
@@ -1242,36 +1529,38 @@ def sql_run(query_id):
     query = cur.fetchone()
     
     if not query:
-        conn.close()
         flash("The query does not exist.", "danger")
         return redirect(url_for("sql_list"))
     
     error = None
     rows = None
     col_names = None
+    truncated = False
     
     if request.method == "POST":
         param = request.form.get("param", "")
         try:
-            sql_text = query['sql_text'].strip()
-            if "?" in sql_text:
-                cur.execute(sql_text, (param,))
-            else:
-                cur.execute(sql_text)
+            # 同一个参数值按 SQL 里 ? 的个数重复绑定
+            params = (param,) * (query['param_count'] or 0)
+            cur.execute(query['sql_text'].strip(), params)
             
             col_names = [desc[0] for desc in cur.description]
-            rows = cur.fetchall()
+            # 任意 SQL 可能返回很多行：最多取 SQL_RESULT_MAX_ROWS 行，再探一行判断是否被截断
+            rows = cur.fetchmany(SQL_RESULT_MAX_ROWS)
+            truncated = cur.fetchone() is not None
+            cur.close()
         except Exception as e:
             error = str(e)
     
-    conn.close()
     return render_template(
         "sql_result.html",
         name=query['name'],
         sql_text=query['sql_text'],
         error=error,
         rows=rows,
-        col_names=col_names
+        col_names=col_names,
+        truncated=truncated,
+        max_rows=SQL_RESULT_MAX_ROWS
     )
 
 
@@ -1293,7 +1582,6 @@ def edit_template(template_id):
     cur.execute("SELECT * FROM templates WHERE id = ?;", (template_id,))
     template = cur.fetchone()
     if not template:
-        conn.close()
         flash("The template does not exist.", "danger")
         return redirect(url_for("templates_list"))
 
@@ -1308,7 +1596,6 @@ def edit_template(template_id):
         # 验证必填字段
         if not name or not topic or not content_html:
             flash("Names, identifiers, and HTML content cannot be empty", "danger")
-            conn.close()
             return render_template("form_edit_template.html", template=template)
 
         # 更新数据库
@@ -1318,16 +1605,17 @@ def edit_template(template_id):
                         topic=?,
                         description=?,
                         content_html=?,
-                        active=?
+                        active=?,
+                        updated_at=strftime('%Y-%m-%d %H:%M:%f', 'now', 'localtime')
                     WHERE id = ?;
                     """, (name, topic, description, content_html, active, template_id))
         conn.commit()
-        conn.close()
+        clear_template_topics()
+        clear_report_cache()
 
         flash("The template has been modified successfully.", "success")
         return redirect(url_for("templates_list"))
 
-    conn.close()
     return render_template("form_edit_template.html", template=template)
 
 @app.route("/admin/init")
@@ -1335,6 +1623,8 @@ def edit_template(template_id):
 def admin_init():
     try:
         init_db()
+        clear_template_topics()
+        clear_report_cache()
         flash("The database structure has been initialized successfully", "success")
     except Exception as e:
         flash(f"Initialization failed: {str(e)}", "danger")
@@ -1352,6 +1642,24 @@ def admin_import():
     return render_template("admin_result.html", message=msg)
 
 
+@app.route("/admin/refresh-stats")
+@login_required
+def admin_refresh_stats():
+    """手工改库后重新计算汇总统计（movie_stats、language_summary 与概况页缓存）。"""
+    try:
+        conn = get_connection()
+        refresh_movie_stats(conn)
+        refresh_language_summary(conn)
+        refresh_overview_cache(conn)
+        clear_report_cache()
+        msg = "The movie statistics have been refreshed"
+        flash(msg, "success")
+    except Exception as e:
+        msg = f"Refresh failed: {str(e)}"
+        flash(msg, "danger")
+    return render_template("admin_result.html", message=msg)
+
+
 @app.route("/admin/insert_defaults")
 @login_required
 def admin_insert_defaults():
@@ -1389,22 +1697,15 @@ def admin_bulk_import():
             df = pd.read_csv(file.stream)
 
             # 数据处理（复用现有逻辑但不清除原有数据）
-            def parse_date(x):
-                if pd.isna(x):
-                    return pd.NaT
-                for fmt in ("%d-%m-%Y", "%Y-%m-%d", "%Y/%m/%d"):
-                    try:
-                        return pd.to_datetime(x, format=fmt)
-                    except Exception:
-                        continue
-                return pd.NaT
-
             if "release_date" in df.columns:
-                df["release_date"] = df["release_date"].apply(parse_date)
-                df["release_year"] = df["release_date"].dt.year
+                # 按格式依次整列解析，前一种格式没解析出来的再用下一种补上
+                s = df["release_date"].astype("string")
+                d = pd.to_datetime(s, format=MOVIE_DATE_FORMATS[0], errors="coerce")
+                for fmt in MOVIE_DATE_FORMATS[1:]:
+                    d = d.fillna(pd.to_datetime(s, format=fmt, errors="coerce"))
+                df["release_date"] = d
             else:
                 df["release_date"] = pd.NaT
-                df["release_year"] = pd.NA
 
             # 处理数值列
             numeric_cols = [c for c in ["popularity", "vote_average", "vote_count"] if c in df.columns]
@@ -1414,20 +1715,29 @@ def admin_bulk_import():
             # 格式化日期
             df["release_date"] = df["release_date"].dt.strftime("%Y-%m-%d")
 
-            # 确保必要列存在
+            # 确保必要列存在（release_year 由数据库根据 release_date 生成）
             required_cols = ["title", "original_language", "release_date",
-                             "release_year", "popularity", "vote_average",
+                             "popularity", "vote_average",
                              "vote_count", "overview"]
             for col in required_cols:
                 if col not in df.columns:
                     df[col] = pd.NA
 
             df = df[required_cols]
+            # 空值统一换成 None 以便 sqlite3 绑定
+            df = df.astype(object).where(df.notna(), None)
 
-            # 追加到数据库（不清除原有数据）
+            # 追加到数据库（不清除原有数据），一个事务内 executemany 一次写完
             conn = get_connection()
-            df.to_sql("movies", conn, if_exists="append", index=False)
-            conn.close()
+            conn.execute("BEGIN;")
+            conn.executemany(MOVIE_INSERT_SQL, df.itertuples(index=False, name=None))
+            conn.commit()
+            refresh_movie_stats(conn)
+            refresh_language_summary(conn)
+            # 批量追加后更新统计信息，让查询规划器选对索引
+            conn.execute("ANALYZE movies;")
+            app.config.pop("OVERVIEW_CACHE", None)
+            clear_report_cache()
 
             return render_template('form_bulk_import.html',
                                    message=f'Successful import {len(df)} film data',
@@ -1444,54 +1754,31 @@ def admin_bulk_import():
 def admin_add_movie():
     if request.method == "POST":
         title = request.form.get("title")
-        lang = request.form.get("lang")
-        release_date = request.form.get("release_date")
-        popularity = request.form.get("popularity")
-        vote_average = request.form.get("vote_average")
-        vote_count = request.form.get("vote_count")
-        overview = request.form.get("overview")
+        lang = _text(request.form.get("lang"))
+        release_date = _text(request.form.get("release_date"))
+        overview = _text(request.form.get("overview"))
         
         if not title:
             flash("The title of the film cannot be empty", "danger")
             return render_template("form_add_movie.html")
         
-        # 处理数字字段
-        def to_float(s):
-            if s and s.strip():
-                return float(s)
-            return 0.0
-
-        def to_int(s):
-            if s and s.strip():
-                return int(s)
-            return 0
-        
-        def to_int(s):
-            return int(s) if s and s.strip() else None
-        
-        popularity = to_float(popularity)
-        vote_average = to_float(vote_average)
-        vote_count = to_int(vote_count)
-        
-        # 提取年份
-        release_year = None
-        if release_date and len(release_date) >= 4:
-            try:
-                release_year = int(release_date[:4])
-            except ValueError:
-                pass
+        # 处理数字字段：按 MOVIE_FORM_NUMBERS 一次转换，填了但不是数字的直接提示
+        raw = {f: (request.form.get(f) or "").strip() for f in MOVIE_FORM_NUMBERS}
+        numbers = {f: coerce(raw[f]) for f, coerce in MOVIE_FORM_NUMBERS.items()}
+        invalid = [f for f in MOVIE_FORM_NUMBERS if raw[f] and numbers[f] is None]
+        if invalid:
+            flash(f"Invalid number: {', '.join(invalid)}", "danger")
+            return render_template("form_add_movie.html")
         
         conn = get_connection()
-        cur = conn.cursor()
-        cur.execute("""
-            INSERT INTO movies 
-            (title, original_language, release_date, release_year, 
-             popularity, vote_average, vote_count, overview)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?);
-        """, (title, lang, release_date, release_year,
-              popularity, vote_average, vote_count, overview))
+        conn.execute(MOVIE_INSERT_SQL, (
+            title, lang, release_date,
+            numbers["popularity"], numbers["vote_average"], numbers["vote_count"], overview))
         conn.commit()
-        conn.close()
+        refresh_movie_stats(conn)
+        refresh_language_summary(conn)
+        app.config.pop("OVERVIEW_CACHE", None)
+        clear_report_cache()
         
         flash("The movie record has been added successfully", "success")
         return redirect(url_for("admin_menu"))
@@ -1503,7 +1790,12 @@ def admin_add_movie():
 
 if __name__ == "__main__":
     # 强制初始化数据库 + 插入默认模板（确保模板数据存在）
-    init_db()
-    insert_default_templates_and_queries()
+    with app.app_context():
+        init_db()
+        insert_default_templates_and_queries()
+
+    # hashlib 正常情况下由 OpenSSL 提供（支持 SHA 硬件指令加速）
+    if not hashlib.sha256.__name__.startswith("openssl_"):
+        app.logger.warning("hashlib.sha256 is not backed by OpenSSL; password hashing will be slower.")
 
     app.run(debug=True, host="127.0.0.1", port=5000)
\ No newline at end of file